@@ -1,46 +1,62 @@
 import os
 import random
 import subprocess
-import pyperclip
+import shutil
 import argparse
 import logging
 import time
-import shlex
+import re
 import enum
+import functools
+import queue
+import atexit
+import sys
 
 from sys import exit
 from typing import Tuple, List, Union
 from filelock import FileLock
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 
 LOCK = FileLock(os.path.join("/", "opt", "scripts", ".gui.lock"))
 LOG_PATH = os.path.join(os.path.expanduser('~'), ".config", "input-simulation")
-os.makedirs(LOG_PATH, exist_ok=True)
-
 try:
-    import pyautogui
-    pyautogui.FAILSAFE = False
-except Exception as e:
-    import traceback
-    import datetime
-
-    error_file = os.path.join(LOG_PATH, "error_input-simulation.log")
-    with open(error_file, "a") as file:
-        file.write("Date and time: \n")
-        file.write(str(datetime.datetime.now()))
-        file.write("\n\n")
-        file.write("Error: \n")
-        file.write("Maybe this computer has no graphical interface? Check the error below: \n")
-        file.write(str(e))
-        file.write("\n\n")
-        file.write("Traceback: \n")
-        file.write(str(traceback.format_exc()))
-        file.write("\n\n")
-        file.write("Environment variables: \n")
-        file.write(str(os.environ))
-        file.write("\n\n")
-    exit(1)
+    os.mkdir(LOG_PATH)  # A single syscall in the common case (the directory already exists)
+except FileExistsError:
+    pass
+except FileNotFoundError:  # First run, with missing parent directories
+    os.makedirs(LOG_PATH, exist_ok=True)
+
+@functools.lru_cache(maxsize=1)
+def import_pyautogui():
+    """Imports pyautogui (only once, when a command needs it) and returns it.
+
+    If it cannot be imported (e.g. no graphical interface), the error is written to a log file and the program exits."""
+    try:
+        import pyautogui
+        pyautogui.FAILSAFE = False
+        pyautogui.PAUSE = 0.0  # No implicit pause after each call, actions are paced with --sleep or sleep actions
+    except Exception as e:
+        import traceback
+        import datetime
+
+        error_file = os.path.join(LOG_PATH, "error_input-simulation.log")
+        with open(error_file, "a") as file:
+            file.write("Date and time: \n")
+            file.write(str(datetime.datetime.now()))
+            file.write("\n\n")
+            file.write("Error: \n")
+            file.write("Maybe this computer has no graphical interface? Check the error below: \n")
+            file.write(str(e))
+            file.write("\n\n")
+            file.write("Traceback: \n")
+            file.write(str(traceback.format_exc()))
+            file.write("\n\n")
+            file.write("Environment variables: \n")
+            file.write(str(os.environ))
+            file.write("\n\n")
+        exit(1)
+    return pyautogui
 
 
 
@@ -55,6 +71,11 @@ DEFAULT_CONFIDENCE = 0.8  # Default confidence for image recognition
 DEFAULT_GRAYSCALE = True  # Default to use grayscale for image recognition
 DEFAULT_TYPING_INTERVAL = RECOMMENDED_TYPING_INTERVAL  # Default interval between typed characters
 DEFAULT_PRESS_INTERVAL = 0.0  # Default interval between key presses when pressing multiple times
+LAST_MATCH_MARGIN = 50  # Margin in pixels around the last match of an image where it is searched first
+PYRAMID_LEVELS = 3  # Levels of the image pyramid used for image recognition (1 means no downscaling)
+PYRAMID_MIN_NEEDLE_SIZE = 8  # Minimum size in pixels of the image to locate at the coarsest pyramid level
+PYRAMID_ROI_MARGIN = 8  # Margin in pixels around the coarse match searched at each upper pyramid level
+EXACT_MATCH_MAX_CANDIDATES = 64  # Maximum positions checked for a pixel-perfect match before using template matching
 
 
 
@@ -104,6 +125,10 @@ MOUSE_ACTIONS_LIST = list(MOUSE_ACTIONS_DICT.keys()) + list(MOUSE_ACTIONS_DICT.v
 MOUSE_ACTIONS_STR = ', '.join(MOUSE_ACTIONS_LIST)
 MOUSE_CLICK_ACTIONS_LIST = [action for action in MOUSE_ACTIONS_LIST if action not in [MouseAction.M, MouseAction.MOVE, MouseAction.S, MouseAction.SLEEP]]
 MOUSE_SLEEP_ACTIONS_LIST = [MouseAction.S, MouseAction.SLEEP]
+MOUSE_ACTIONS_SET = frozenset(MOUSE_ACTIONS_LIST)
+MOUSE_CLICK_ACTIONS_SET = frozenset(MOUSE_CLICK_ACTIONS_LIST)
+MOUSE_ACTIONS_CANON = {**{action: action for action in MOUSE_ACTIONS_DICT.values()}, **MOUSE_ACTIONS_DICT}  # Any action name -> full name
+MOUSE_ACTIONS_CANON.update({action.lower(): canon for action, canon in MOUSE_ACTIONS_CANON.items()})  # Also in lowercase, to skip upper() for them
 
 KEYBOARD_ACTIONS_LIST = [
     KeyboardAction.KEY, 
@@ -116,24 +141,93 @@ KEYBOARD_ACTIONS_LIST = [
     KeyboardAction.S
 ]
 KEYBOARD_ACTIONS_STR = ', '.join(KEYBOARD_ACTIONS_LIST)
+KEYBOARD_ACTIONS_SET = frozenset(KEYBOARD_ACTIONS_LIST)
 KEYBOARD_SLEEP_ACTIONS_LIST = [KeyboardAction.S, KeyboardAction.SLEEP]
 KEYBOARD_KEY_ACTIONS_LIST = [KeyboardAction.K, KeyboardAction.KEY]
 KEYBOARD_TYPE_ACTIONS_LIST = [KeyboardAction.T, KeyboardAction.TYPE]
 KEYBOARD_TYPEFILE_ACTIONS_LIST = [KeyboardAction.TF, KeyboardAction.TYPEFILE]
+KEYBOARD_ACTIONS_CANON = {  # Any action name -> full name
+    **{action: KeyboardAction.SLEEP for action in KEYBOARD_SLEEP_ACTIONS_LIST},
+    **{action: KeyboardAction.KEY for action in KEYBOARD_KEY_ACTIONS_LIST},
+    **{action: KeyboardAction.TYPE for action in KEYBOARD_TYPE_ACTIONS_LIST},
+    **{action: KeyboardAction.TYPEFILE for action in KEYBOARD_TYPEFILE_ACTIONS_LIST}
+}
+KEYBOARD_ACTIONS_CANON.update({action.lower(): canon for action, canon in KEYBOARD_ACTIONS_CANON.items()})  # Also in lowercase, to skip upper() for them
+
+SLEEP_ACTIONS_SET = frozenset({MouseAction.SLEEP, KeyboardAction.SLEEP})  # Sleep actions once parsed
 
-BTN_MAPPING = {
-    MouseAction.DOUBLELEFT: pyautogui.LEFT,
-    MouseAction.LEFT: pyautogui.LEFT, 
-    MouseAction.RIGHT: pyautogui.RIGHT, 
-    MouseAction.MIDDLE: pyautogui.MIDDLE
+BTN_MAPPING = {  # Mouse action -> (pyautogui button, X button number, number of clicks), all resolved with one lookup per click
+    MouseAction.DOUBLELEFT: ("left", 1, 2),
+    MouseAction.LEFT: ("left", 1, 1),
+    MouseAction.RIGHT: ("right", 3, 1),
+    MouseAction.MIDDLE: ("middle", 2, 1)
 }
 
-TWEENING_FUNCTIONS = [
-    pyautogui.easeInOutCirc,
-    pyautogui.easeOutBack
-]
+TWEENING_FUNCTIONS = (  # Names of pyautogui tweening functions (two, so one is picked with a single random bit)
+    "easeInOutCirc",
+    "easeOutBack"
+)
+
+ACTIONS_TOKEN_RE = re.compile(  # Pieces of a string of actions, following the shlex POSIX rules
+    r"""(?P<space>[ \t\r\n]+)|(?P<plain>[^ \t\r\n'"\\]+)|(?P<single>'[^']*')|(?P<double>"(?:[^"\\]|\\.)*")|(?P<escaped>\\.)""",
+    re.DOTALL
+)
+DOUBLE_QUOTE_ESCAPE_RE = re.compile(r'\\(["\\])')  # Inside double quotes, a backslash only escapes a double quote or a backslash
+
+MOUSE_ITEM_RE = re.compile(  # Mouse action, the last group matched tells its format (see MOUSE_ITEM_PARSERS)
+    r"(?:(?P<btn>[^,]+),)?(?P<x>\d+|[+-]\d+),(?P<y>\d+|[+-]\d+)|(?P<action>[^,]+),(?P<arg>[^,]+)|(?P<single>[^,]+)"
+)
+REGION_RE = re.compile(r"\d+,\d+,\d+,\d+")  # Area of the screen as left,top,width,height
+ACTION_REGION_RE = re.compile(r"(?P<action>.+)@(?P<region>\d+,\d+,\d+,\d+)")  # Image action followed by the region to search in
 
 PROBLEMATIC_CHARS = set("@|#$%&/()=?¡¿'\"\\[]{}^`~¬¨*+-_:;<>")
+PROBLEMATIC_CHARS_SET_RE = "".join(re.escape(ch) for ch in sorted(PROBLEMATIC_CHARS)) + "\x7f-\U0010ffff"  # Chars above 126 are always problematic
+PROBLEMATIC_RUNS_RE = re.compile(f"(?P<problem>[{PROBLEMATIC_CHARS_SET_RE}]+)|(?P<normal>[^{PROBLEMATIC_CHARS_SET_RE}]+)")
+
+XDOTOOL_KEYS = {  # pyautogui key name -> X keysym for xdotool (as pyautogui maps them on X11), only ASCII letters and digits are passed as they are
+    "enter": "Return", "return": "Return", "\n": "Return", "\r": "Return", "tab": "Tab", "\t": "Tab",
+    "esc": "Escape", "escape": "Escape", "space": "space", " ": "space",
+    "backspace": "BackSpace", "\b": "BackSpace", "delete": "Delete", "del": "Delete", "insert": "Insert",
+    "home": "Home", "end": "End", "pageup": "Prior", "pgup": "Prior", "pagedown": "Next", "pgdn": "Next",
+    "up": "Up", "down": "Down", "left": "Left", "right": "Right",
+    "ctrl": "Control_L", "ctrlleft": "Control_L", "ctrlright": "Control_R",
+    "alt": "Alt_L", "altleft": "Alt_L", "altright": "Alt_R", "option": "Alt_L", "optionleft": "Alt_L", "optionright": "Alt_R",
+    "shift": "Shift_L", "shiftleft": "Shift_L", "shiftright": "Shift_R",
+    "win": "Super_L", "winleft": "Super_L", "winright": "Super_R", "super": "Super_L", "command": "Super_L",
+    "capslock": "Caps_Lock", "numlock": "Num_Lock", "scrolllock": "Scroll_Lock",
+    "printscreen": "Print", "print": "Print", "prtsc": "Print", "prtscr": "Print", "prntscrn": "Print", "pause": "Pause", "apps": "Menu",
+    "select": "Select", "execute": "Execute", "help": "Help", "clear": "Clear", "sleep": "XF86Sleep",
+    **{f"num{i}": f"KP_{i}" for i in range(10)},
+    "multiply": "KP_Multiply", "add": "KP_Add", "separator": "KP_Separator", "subtract": "KP_Subtract", "decimal": "KP_Decimal", "divide": "KP_Divide",
+    "volumeup": "XF86AudioRaiseVolume", "volumedown": "XF86AudioLowerVolume", "volumemute": "XF86AudioMute",
+    "playpause": "XF86AudioPlay", "stop": "XF86AudioStop", "nexttrack": "XF86AudioNext", "prevtrack": "XF86AudioPrev",
+    "browserback": "XF86Back", "browserforward": "XF86Forward", "browserrefresh": "XF86Refresh", "browserstop": "XF86Stop",
+    "browsersearch": "XF86Search", "browserfavorites": "XF86Favorites", "browserhome": "XF86HomePage",
+    "launchmail": "XF86Mail", "launchmediaselect": "XF86AudioMedia", "launchapp1": "XF86MyComputer", "launchapp2": "XF86Calculator",
+    "kana": "Kana_Lock", "kanji": "Kanji", "hangul": "Hangul", "hanguel": "Hangul", "hanja": "Hangul_Hanja",
+    "convert": "Henkan", "nonconvert": "Muhenkan", "modechange": "Mode_switch", "yen": "yen",
+    **dict(zip("!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~", [
+        "exclam", "quotedbl", "numbersign", "dollar", "percent", "ampersand", "apostrophe", "parenleft", "parenright", "asterisk",
+        "plus", "comma", "minus", "period", "slash", "colon", "semicolon", "less", "equal", "greater", "question", "at",
+        "bracketleft", "backslash", "bracketright", "asciicircum", "underscore", "grave", "braceleft", "bar", "braceright", "asciitilde"
+    ])),
+    **{f"f{i}": f"F{i}" for i in range(1, 25)}
+}
+
+XTEST_CHAR_KEYSYMS = {"\n": 0xff0d, "\t": 0xff09}  # Characters whose X keysym is not their Latin-1 code (Return, Tab)
+
+UINPUT_KEY_NAMES = {  # Character -> (evdev key name, needs shift), assuming a US keyboard layout
+    **{ch: (f"KEY_{ch.upper()}", False) for ch in "abcdefghijklmnopqrstuvwxyz"},
+    **{ch: (f"KEY_{ch}", True) for ch in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"},
+    **{ch: (f"KEY_{ch}", False) for ch in "1234567890"},
+    **{ch: (f"KEY_{digit}", True) for ch, digit in zip("!@#$%^&*()", "1234567890")},
+    **{ch: (name, False) for ch, name in zip("-=[]\\;',./`", ["KEY_MINUS", "KEY_EQUAL", "KEY_LEFTBRACE", "KEY_RIGHTBRACE", "KEY_BACKSLASH", "KEY_SEMICOLON", "KEY_APOSTROPHE", "KEY_COMMA", "KEY_DOT", "KEY_SLASH", "KEY_GRAVE"])},
+    **{ch: (name, True) for ch, name in zip("_+{}|:\"<>?~", ["KEY_MINUS", "KEY_EQUAL", "KEY_LEFTBRACE", "KEY_RIGHTBRACE", "KEY_BACKSLASH", "KEY_SEMICOLON", "KEY_APOSTROPHE", "KEY_COMMA", "KEY_DOT", "KEY_SLASH", "KEY_GRAVE"])},
+    " ": ("KEY_SPACE", False),
+    "\t": ("KEY_TAB", False),
+    "\n": ("KEY_ENTER", False),
+}
+UINPUT_SETUP_TIME = 0.2  # Time for the display server to pick up a newly created uinput device
 
 
 
@@ -142,13 +236,27 @@ PROBLEMATIC_CHARS = set("@|#$%&/()=?¡¿'\"\\[]{}^`~¬¨*+-_:;<>")
 format_str = "%(asctime)s [PID %(process)d] - %(funcName)s - %(levelname)s - %(message)s"
 class LevelBasedFormatter(logging.Formatter):
     """Custom formatter to change format based on log level."""
+    def __init__(self):
+        super().__init__(format_str)
+        self.info_formatter = logging.Formatter("%(message)s")  # Created once, not per record
+
     def format(self, record):
         if record.levelno == logging.INFO:
-            fmt = "%(message)s"
-        else:
-            fmt = format_str
-        formatter = logging.Formatter(fmt)
-        return formatter.format(record)
+            return self.info_formatter.format(record)
+        return super().format(record)
+
+
+class SizeFirstRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that checks the size of the log file before its type, so records that do not roll over cost no stat() calls."""
+    def shouldRollover(self, record):
+        if self.stream is None:
+            self.stream = self._open()
+        if self.maxBytes > 0:
+            msg = "%s\n" % self.format(record)
+            self.stream.seek(0, 2)
+            if self.stream.tell() + len(msg) >= self.maxBytes:
+                return os.path.isfile(self.baseFilename) or not os.path.exists(self.baseFilename)  # Only regular files roll over (bpo-45401)
+        return False
 
 
 formatter = logging.Formatter(format_str)
@@ -158,13 +266,20 @@ logger.setLevel(logging.DEBUG)
 console_handler = logging.StreamHandler()
 logger.addHandler(console_handler)
 
-file_handler = RotatingFileHandler(
-    os.path.join(os.path.expanduser(LOG_PATH), 'input-simulation.log'),
+file_handler = SizeFirstRotatingFileHandler(
+    os.path.join(LOG_PATH, 'input-simulation.log'),  # LOG_PATH is already expanded
     maxBytes=1024*1024, 
-    backupCount=3
+    backupCount=3,
+    delay=True  # Opened with the first record, so --help and argument errors do not touch the log file
 )
 file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+
+log_queue = queue.SimpleQueue()  # The file handler writes from a background thread, so actions never wait on the log file
+# The file log keeps every DEBUG record, so their messages are still built on the calling thread (in QueueHandler.prepare)
+logger.addHandler(QueueHandler(log_queue))
+file_listener = QueueListener(log_queue, file_handler)
+file_listener.start()
+atexit.register(file_listener.stop)  # Writes the pending records, also when exiting with exit(1)
 
 
 
@@ -180,6 +295,7 @@ example:
   right click           mouse "R,100,200" or mouse "RIGHT,100,200"
   middle click          mouse "W,100,200" or mouse "MIDDLE,100,200"
   click on image        mouse "L,/path/to/image.png"
+  click on image area   mouse "L,/path/to/image.png@0,0,400,300" (searches the image only in the 400x300 area at the top left corner)
   click current         mouse "L" or click "R" or click "M" or click "LL" (or their full names)
   click relative        mouse "L,+50,-30" (50 right, 30 up from current position) (use +0 when you want to move only in one axis)
   sleep                 mouse "S,2.5" or mouse "SLEEP,2.5" (sleeps 2.5 seconds)
@@ -208,69 +324,428 @@ example:
 
 # Auxiliary functions (typing, validations, checks)
 
-def type_with_xdotool_single(text):
-    subprocess.run(["xdotool", "type", "--clearmodifiers", text])
-
-
 def type_text(text, interval=MIN_TYPING_INTERVAL):
     """DEPRECATED: this function is very slow.
 
-    Type text using pyautogui, handling problematic characters with xdotool."""
-    buffer = ""
+    Type text using pyautogui, handling problematic characters with xdotool.
+    The text is split into runs of normal and problematic characters, each problematic run is typed with a single xdotool call."""
+    pyautogui = import_pyautogui()
+    for match in PROBLEMATIC_RUNS_RE.finditer(text):
+        if match.lastgroup == "problem":
+            subprocess.run(["xdotool", "type", "--clearmodifiers", "--delay", "0", match.group()])
+        else:
+            pyautogui.write(match.group(), interval=interval)
 
-    def flush_buffer():
-        nonlocal buffer
-        if buffer:
-            pyautogui.write(buffer, interval=interval)
-            buffer = ""
 
-    for ch in text:
-        if ch in PROBLEMATIC_CHARS or ord(ch) > 126:
-            # First, write the buffer if not empty
-            flush_buffer()
-            # Paste the problematic character using xdotool
-            type_with_xdotool_single(ch)
-        else:
-            buffer += ch
+def xdotool_type_command(interval=MIN_TYPING_INTERVAL) -> List[str]:
+    """Returns the xdotool command that types the text read from its stdin, with interval seconds between characters.
 
-    flush_buffer()
+    xdotool types the text as it is (newlines as Return), it is not parsed as a script."""
+    if 0.0 < interval < MIN_TYPING_INTERVAL:  # Already 0 when coming from the command line
+        logger.debug("Interval %s too low, typing whole text at once.", interval)
+        interval = 0
+    interval = str(interval * 1000)  # Convert to milliseconds for xdotool
+    return ["xdotool", "type", "--clearmodifiers", "--delay", interval, "--file", "-"]
 
 
 def type_with_xdotool(text: str, interval=MIN_TYPING_INTERVAL):
-    if interval < MIN_TYPING_INTERVAL:
-        logger.debug(f"Interval {interval} too low, typing whole text at once.")
-        pyperclip.copy(text)
-        pyautogui.hotkey("ctrl", "v")
+    """Type text with a single xdotool process, writing the text to its stdin.
+
+    The process is waited on before returning, so the typing does not overlap with later actions."""
+    subprocess.run(xdotool_type_command(interval), input=text, text=True)
+
+
+def type_file_with_xdotool(file, interval=MIN_TYPING_INTERVAL):
+    """Type the content of an open text file with a single xdotool process, streaming the file to its stdin (see type_with_xdotool).
+
+    Raises BrokenPipeError if xdotool exits before reading the whole file."""
+    with subprocess.Popen(xdotool_type_command(interval), stdin=subprocess.PIPE, text=True) as proc:  # Waited on when leaving
+        shutil.copyfileobj(file, proc.stdin)
+
+
+@functools.lru_cache(maxsize=1)
+def get_mss():
+    """Creates (once) the mss instance used to take screenshots, returns None if mss is not installed."""
+    try:
+        import mss
+    except ImportError:
+        logger.debug("mss not available, taking screenshots with pyautogui")
+        return None
+    return mss.mss()
+
+
+def grab_screen(grayscale: bool=DEFAULT_GRAYSCALE) -> "np.ndarray":
+    """Takes a screenshot (with mss if installed, as it reads the pixels straight from the display) and returns it as an OpenCV image (grayscale or BGR)."""
+    import cv2  # Imported here so commands without image actions do not pay its import time
+    import numpy as np
+    if (sct := get_mss()) is not None:
+        screen = np.asarray(sct.grab(sct.monitors[0]))  # All monitors, as pyautogui does
+        return cv2.cvtColor(screen, cv2.COLOR_BGRA2GRAY if grayscale else cv2.COLOR_BGRA2BGR)
+    screen = np.asarray(import_pyautogui().screenshot())
+    return cv2.cvtColor(screen, cv2.COLOR_RGB2GRAY if grayscale else cv2.COLOR_RGB2BGR)
+
+
+def match_exact(haystack: "np.ndarray", needle: "np.ndarray") -> Union[Tuple[int, int, int, int], None]:
+    """Finds a pixel-perfect copy of the needle in the haystack and returns its box (left, top, width, height) or None if not found.
+
+    Only the positions where the top left pixel of the needle appears are compared, and only if there are few of them."""
+    import numpy as np
+    needle_h, needle_w = needle.shape[:2]
+    starts = haystack[:haystack.shape[0] - needle_h + 1, :haystack.shape[1] - needle_w + 1] == needle[0, 0]
+    if starts.ndim == 3:  # BGR, all the channels must be equal
+        starts = starts.all(axis=2)
+    ys, xs = np.nonzero(starts)
+    if len(ys) > EXACT_MATCH_MAX_CANDIDATES:
+        return None
+    for y, x in zip(ys.tolist(), xs.tolist()):
+        if np.array_equal(haystack[y:y + needle_h, x:x + needle_w], needle):
+            return (x, y, needle_w, needle_h)
+    return None
+
+
+def match_template_pyramid(
+    haystack: "np.ndarray",
+    needle: "np.ndarray",
+    confidence: float=DEFAULT_CONFIDENCE
+) -> Union[Tuple[int, int, int, int], None]:
+    """Finds the needle in the haystack and returns its box (left, top, width, height) or None if not found.
+
+    The match is first done on images downscaled with a Gaussian pyramid and then refined on a small area of each upper level.
+    If the refined match does not reach the confidence, the whole haystack is searched at full resolution.
+    A pixel-perfect copy of the needle is looked for first (see match_exact), as it skips all the template matching."""
+    import cv2
+    needle_h, needle_w = needle.shape[:2]
+    if needle_h > haystack.shape[0] or needle_w > haystack.shape[1]:
+        return None
+    if (box := match_exact(haystack, needle)) is not None:
+        logger.debug("Pixel-perfect match found")
+        return box
+
+    haystacks, needles = [haystack], [needle]
+    while len(haystacks) < PYRAMID_LEVELS and min(needles[-1].shape[:2]) >= 2 * PYRAMID_MIN_NEEDLE_SIZE:
+        haystacks.append(cv2.pyrDown(haystacks[-1]))
+        needles.append(cv2.pyrDown(needles[-1]))
+
+    result = cv2.matchTemplate(haystacks[-1], needles[-1], cv2.TM_CCOEFF_NORMED)
+    _, max_val, _, (x, y) = cv2.minMaxLoc(result)
+    for level_haystack, level_needle in zip(reversed(haystacks[:-1]), reversed(needles[:-1])):
+        level_h, level_w = level_needle.shape[:2]
+        x0 = max(min(2 * x - PYRAMID_ROI_MARGIN, level_haystack.shape[1] - level_w), 0)
+        y0 = max(min(2 * y - PYRAMID_ROI_MARGIN, level_haystack.shape[0] - level_h), 0)
+        roi = level_haystack[y0:2 * y + level_h + PYRAMID_ROI_MARGIN, x0:2 * x + level_w + PYRAMID_ROI_MARGIN]
+        result = cv2.matchTemplate(roi, level_needle, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, (x, y) = cv2.minMaxLoc(result)
+        x, y = x0 + x, y0 + y
+
+    if max_val < confidence and len(haystacks) > 1:
+        logger.debug("Pyramid match below confidence (%.3f), searching at full resolution", max_val)
+        result = cv2.matchTemplate(haystack, needle, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, (x, y) = cv2.minMaxLoc(result)
+    if max_val < confidence:
+        return None
+    return (x, y, needle_w, needle_h)
+
+
+@functools.lru_cache(maxsize=64)
+def load_needle(img_path: str, grayscale: bool=DEFAULT_GRAYSCALE) -> Union["np.ndarray", None]:
+    """Reads (once) an image to locate as an OpenCV image (grayscale or BGR), returns None if it cannot be read."""
+    import cv2
+    return cv2.imread(img_path, cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR)
+
+
+def locate_on_screenshot(
+    img_path: str,
+    screen: "np.ndarray",
+    last_box: Union[Tuple[int, int, int, int], None]=None,
+    region: Union[Tuple[int, int, int, int], None]=None,
+    confidence: float=DEFAULT_CONFIDENCE,
+    grayscale: bool=DEFAULT_GRAYSCALE
+) -> Union[Tuple[int, int, int, int], None]:
+    """Locates an image on a screenshot (see grab_screen) and returns its box (left, top, width, height) or None if not found.
+
+    If region (left, top, width, height) is given, only that area of the screenshot is searched.
+    If last_box is given, the area around it is searched first and the whole screenshot (or region) only if the image is not there."""
+    if (needle := load_needle(img_path, grayscale)) is None:
+        logger.error("Image '%s' could not be read.", img_path)
+        exit(1)
+
+    offset_x, offset_y = 0, 0
+    if region is not None:
+        offset_x, offset_y, width, height = region
+        screen = screen[offset_y:offset_y + height, offset_x:offset_x + width]
+
+    if last_box is not None:
+        left, top, width, height = last_box
+        left, top = max(left - offset_x - LAST_MATCH_MARGIN, 0), max(top - offset_y - LAST_MATCH_MARGIN, 0)
+        right, bottom = last_box[0] - offset_x + width + LAST_MATCH_MARGIN, last_box[1] - offset_y + height + LAST_MATCH_MARGIN
+        if right > 0 and bottom > 0 and (box := match_template_pyramid(screen[top:bottom, left:right], needle, confidence)) is not None:
+            logger.debug("Image found near its last match %s", last_box)
+            return (box[0] + left + offset_x, box[1] + top + offset_y, box[2], box[3])
+    if (box := match_template_pyramid(screen, needle, confidence)) is None:
+        return None
+    return (box[0] + offset_x, box[1] + offset_y, box[2], box[3])
+
+
+def clamp_to_screen(x: int, y: int, screen_size: Tuple[int, int]) -> Tuple[int, int]:
+    """Returns where the mouse ends when moved to (x, y), since it is kept on the screen (of screen_size width and height)."""
+    return min(max(x, 0), screen_size[0] - 1), min(max(y, 0), screen_size[1] - 1)
+
+
+def get_xdotool_combination(keys: List[str]) -> Union[str, None]:
+    """Returns a key combination (pyautogui key names) as xdotool takes it (X keysyms joined by +), or None if a key has no known keysym."""
+    keysyms = [XDOTOOL_KEYS.get(key, key if key.isascii() and key.isalnum() and len(key) == 1 else None) for key in keys]
+    return None if None in keysyms else "+".join(keysyms)
+
+
+def press_hotkey_with_xdotool(combination: str, presses: int=1, interval: float=DEFAULT_PRESS_INTERVAL):
+    """Press a key combination (as returned by get_xdotool_combination) several times with xdotool, a single call if there is no interval.
+
+    xdotool applies its --delay to every key event of a combination, not between combinations, so the interval is slept here."""
+    if interval > 0.0:
+        for i in range(presses):
+            if i > 0:
+                time.sleep(interval)
+            subprocess.run(["xdotool", "key", "--delay", "0", combination])
     else:
-        lines = text.splitlines(keepends=True)
-        interval = str(interval * 1000)  # Convert to milliseconds for xdotool
-        for line in lines:
-            if line.endswith('\n'):
-                subprocess.run(["xdotool", "type", "--clearmodifiers", "--delay", interval, line[:-1]])
-                subprocess.run(["xdotool", "key", "Return"])
-            else:
-                subprocess.run(["xdotool", "type", "--clearmodifiers", "--delay", interval, line])
+        subprocess.run(["xdotool", "key", "--delay", "0"] + [combination] * presses)
+
+
+@functools.lru_cache(maxsize=1)
+def get_xtest_display():
+    """Opens (once) the X display used to click and press keys through the XTEST extension, returns None if it is not available."""
+    try:
+        from Xlib.display import Display
+        display = Display()
+        if not display.has_extension("XTEST"):
+            return None
+        return display
+    except Exception as e:
+        logger.debug("XTEST not available, clicking and pressing keys with pyautogui: %s", e)
+        return None
+
+
+def move_with_xtest(display, x: int, y: int):
+    """Moves the mouse to (x, y) with a fake XTEST event, skipping pyautogui.
+
+    The event is sent (flushed) but not waited on, call display.sync() before reading anything from the display."""
+    from Xlib import X
+    from Xlib.ext import xtest
+    xtest.fake_input(display, X.MotionNotify, x=x, y=y)
+    display.flush()
+
+
+def click_with_xtest(display, x: int, y: int, button: int, clicks: int=1, interval: float=0.0):
+    """Moves the mouse to (x, y) and clicks a button (X button number) with fake XTEST events, skipping pyautogui.
+
+    The events are sent (flushed) but not waited on, call display.sync() before reading anything from the display."""
+    from Xlib import X
+    from Xlib.ext import xtest
+    xtest.fake_input(display, X.MotionNotify, x=x, y=y)
+    for i in range(clicks):
+        if i > 0 and interval > 0.0:
+            display.flush()
+            time.sleep(interval)
+        xtest.fake_input(display, X.ButtonPress, button)
+        xtest.fake_input(display, X.ButtonRelease, button)
+    display.flush()
+
+
+def get_xtest_keycode(display, key: str) -> Union[int, None]:
+    """Returns the keycode of a key (pyautogui key name) to press it through XTEST, or None if it is not on the keyboard map or needs a modifier."""
+    from Xlib import XK
+    if (keysym := XK.string_to_keysym(XDOTOOL_KEYS.get(key, key))) == 0:
+        return None
+    keycode = display.keysym_to_keycode(keysym)
+    if keycode == 0 or display.keycode_to_keysym(keycode, 0) != keysym:  # Like uppercase letters, that need shift
+        return None
+    return keycode
+
+
+def press_with_xtest(display, keycode: int, presses: int=1, interval: float=DEFAULT_PRESS_INTERVAL):
+    """Presses a key (keycode) several times with fake XTEST events, skipping pyautogui. Waits for the X server to process them."""
+    from Xlib import X
+    from Xlib.ext import xtest
+    for i in range(presses):
+        if i > 0 and interval > 0.0:
+            display.flush()
+            time.sleep(interval)
+        xtest.fake_input(display, X.KeyPress, keycode)
+        xtest.fake_input(display, X.KeyRelease, keycode)
+    display.sync()
+
+
+def get_xtest_text_keys(display, text: str) -> Union[List[Tuple[int, bool]], None]:
+    """Returns (keycode, needs shift) for each character of a text to type it through XTEST, or None if a character is not on the keyboard map."""
+    keys = {}
+    for ch in set(text):
+        keysym = XTEST_CHAR_KEYSYMS.get(ch) or (ord(ch) if ord(ch) <= 0xff else 0)  # Only Latin-1 keysyms match the character code
+        if keysym == 0 or (keycode := display.keysym_to_keycode(keysym)) == 0:
+            return None
+        if display.keycode_to_keysym(keycode, 0) == keysym:
+            keys[ch] = (keycode, False)
+        elif display.keycode_to_keysym(keycode, 1) == keysym:
+            keys[ch] = (keycode, True)
+        else:  # Needs another modifier (e.g. AltGr)
+            return None
+    return [keys[ch] for ch in text]
+
+
+def type_with_xtest(display, keys: List[Tuple[int, bool]]):
+    """Types a text at once, given as (keycode, needs shift) for each character, with fake XTEST events sent in a single flush.
+    Waits for the X server to process them."""
+    from Xlib import X, XK
+    from Xlib.ext import xtest
+    shift = display.keysym_to_keycode(XK.XK_Shift_L)
+    for keycode, needs_shift in keys:
+        if needs_shift:
+            xtest.fake_input(display, X.KeyPress, shift)
+        xtest.fake_input(display, X.KeyPress, keycode)
+        xtest.fake_input(display, X.KeyRelease, keycode)
+        if needs_shift:
+            xtest.fake_input(display, X.KeyRelease, shift)
+    display.sync()
+
+
+@functools.lru_cache(maxsize=1)
+def get_uinput_keys() -> Union[dict, None]:
+    """Imports python-evdev and builds (once) the uinput keymap, character -> (evdev key code, needs shift). Returns None if python-evdev is not installed."""
+    try:
+        from evdev import ecodes  # Optional, only needed to type with --uinput
+    except ImportError:
+        return None
+    return {ch: (getattr(ecodes, name), shift) for ch, (name, shift) in UINPUT_KEY_NAMES.items()}
+
+
+def check_uinput() -> bool:
+    """Checks if typing through uinput is possible (python-evdev installed and /dev/uinput writable)."""
+    return get_uinput_keys() is not None and os.access("/dev/uinput", os.W_OK)
+
+
+@functools.lru_cache(maxsize=1)
+def get_uinput() -> "evdev.UInput":
+    """Creates (once) the virtual keyboard used to type through uinput."""
+    from evdev import UInput, ecodes
+    logger.debug("Creating uinput virtual keyboard")
+    ui = UInput({ecodes.EV_KEY: sorted({code for code, _ in get_uinput_keys().values()} | {ecodes.KEY_LEFTSHIFT})}, name="input-simulation")
+    time.sleep(UINPUT_SETUP_TIME)
+    return ui
+
+
+def type_with_uinput(text: str, interval=MIN_TYPING_INTERVAL):
+    """Type text writing key events to a virtual uinput keyboard. All the characters must be in the uinput keymap (see get_uinput_keys)."""
+    from evdev import ecodes
+    ui = get_uinput()
+    keys = get_uinput_keys()
+    interval = interval if interval >= MIN_TYPING_INTERVAL else 0.0
+    for ch in text:
+        code, shift = keys[ch]
+        if shift:
+            ui.write(ecodes.EV_KEY, ecodes.KEY_LEFTSHIFT, 1)
+        ui.write(ecodes.EV_KEY, code, 1)
+        ui.write(ecodes.EV_KEY, code, 0)
+        if shift:
+            ui.write(ecodes.EV_KEY, ecodes.KEY_LEFTSHIFT, 0)
+        ui.syn()
+        if interval > 0.0:
+            time.sleep(interval)
+
+
+@functools.lru_cache(maxsize=1)
+def get_wtype() -> Union[str, None]:
+    """Returns the path of wtype if this is a Wayland session, it is installed and it works (checked once), None otherwise."""
+    if not os.environ.get("WAYLAND_DISPLAY") or (wtype := shutil.which("wtype")) is None:
+        return None
+    if subprocess.run([wtype, "-s", "0"], capture_output=True).returncode != 0:  # E.g. compositors without the virtual keyboard protocol (GNOME)
+        logger.debug("wtype does not work in this session, typing with xdotool.")
+        return None
+    return wtype
+
+
+def type_with_wtype(wtype: str, text: str) -> bool:
+    """Type text with wtype, which reads it from its stdin. Returns False if wtype failed."""
+    if subprocess.run([wtype, "-"], input=text, text=True).returncode == 0:
+        return True
+    logger.warning("wtype could not type the text, typing with xdotool.")
+    return False
+
+
+def type_file_with_wtype(wtype: str, file) -> bool:
+    """Type the content of an open file with wtype, which reads the file itself as its stdin. Returns False if wtype failed, with the file back at its start."""
+    if subprocess.run([wtype, "-"], stdin=file).returncode == 0:
+        return True
+    logger.warning("wtype could not type the file, typing with xdotool.")
+    file.seek(0)
+    return False
+
+
+def type_string(text: str, interval=MIN_TYPING_INTERVAL, uinput=False):
+    """Type text through uinput if requested and every character can be typed that way, otherwise with xdotool.
+
+    When the whole text is typed at once (interval below the minimum), wtype is used in a Wayland session if it works,
+    or XTEST if every character is on the keyboard map."""
+    if uinput and get_uinput_keys().keys() >= set(text):  # Only when check_uinput passed, so python-evdev is installed
+        type_with_uinput(text, interval=interval)
+        return
+    if uinput:
+        logger.debug("Text has characters not available in the uinput keymap, typing with xdotool.")
+    if interval < MIN_TYPING_INTERVAL and (wtype := get_wtype()) is not None and type_with_wtype(wtype, text):
+        return
+    if interval < MIN_TYPING_INTERVAL and (display := get_xtest_display()) is not None and (keys := get_xtest_text_keys(display, text)) is not None:
+        type_with_xtest(display, keys)  # No xdotool process to start
+    else:
+        type_with_xdotool(text, interval=interval)
+
+
+def split_actions(actions_str: str) -> List[str]:
+    """Splits a string of actions by whitespace except inside quotes, removing the quotes. Same result as shlex.split, but faster."""
+    if actions_str.isprintable() and "'" not in actions_str and '"' not in actions_str and "\\" not in actions_str:
+        return actions_str.split()  # Nothing to unquote or escape, and (being printable) spaces are the only whitespace
+    tokens = []
+    token = None  # Parts of the current token, None if between tokens
+    pos, end = 0, len(actions_str)
+    while pos < end:
+        if (match := ACTIONS_TOKEN_RE.match(actions_str, pos)) is None:
+            raise ValueError("No closing quotation" if actions_str[pos] in "'\"" else "No escaped character")
+        pos = match.end()
+        kind = match.lastgroup
+        if kind == "space":
+            if token is not None:
+                tokens.append("".join(token))
+                token = None
+            continue
+        if token is None:
+            token = []
+        if kind == "plain":
+            token.append(match.group())
+        elif kind == "single":
+            token.append(match.group()[1:-1])
+        elif kind == "double":
+            token.append(DOUBLE_QUOTE_ESCAPE_RE.sub(r"\1", match.group()[1:-1]))
+        else:  # Escaped character
+            token.append(match.group()[1])
+    if token is not None:
+        tokens.append("".join(token))
+    return tokens
 
 
 def validate_mouse_action(action: str) -> str:
-    """Validates a click action string and returns with the action in uppercase."""
-    if (action_validated := action.upper()) in MOUSE_ACTIONS_LIST:
-        return MOUSE_ACTIONS_DICT.get(action_validated, action_validated)
-    else:
+    """Validates a click action string and returns the action with its full name."""
+    if (canon := MOUSE_ACTIONS_CANON.get(action)) is None and (canon := MOUSE_ACTIONS_CANON.get(action.upper())) is None:
         raise ValueError(f"Invalid action '{action}'. Use {MOUSE_ACTIONS_STR}.")
+    return canon
     
 
 def validate_keyboard_action(action: str) -> str:
-    """Validates a keyboard action string and returns with the action in uppercase."""
-    if (action_validated := action.upper()) in KEYBOARD_ACTIONS_LIST:
-        return action_validated
-    else:
+    """Validates a keyboard action string and returns the action with its full name."""
+    if (canon := KEYBOARD_ACTIONS_CANON.get(action)) is None and (canon := KEYBOARD_ACTIONS_CANON.get(action.upper())) is None:
         raise ValueError(f"Invalid action '{action}'. Use {KEYBOARD_ACTIONS_STR}.")
+    return canon
     
 
+@functools.lru_cache(maxsize=256)
 def validate_file_path(path: str, directory: Union[str, None]=None) -> str:
-    """Validates if a path is a valid file path and returns the absolute path."""
-    logger.debug(f"Validating file path: {path} with directory: {directory}")
+    """Validates if a path is a valid file path and returns the absolute path. Results are cached, as paths are stable during a run."""
+    logger.debug("Validating file path: %s with directory: %s", path, directory)
     if directory:
         directory = os.path.abspath(os.path.expanduser(directory))
         path = os.path.join(directory, path)
@@ -282,23 +757,14 @@ def validate_file_path(path: str, directory: Union[str, None]=None) -> str:
     return path
     
 
-def validate_coordinate(coord: str) -> Union[int, str]:
-    """Checks if a value is a valid coordinate (integer or relative integer) and returns them as integers if they are absolute or strings if they are relative."""
-    if coord.isdigit():
-        return int(coord)
-    elif (coord.startswith("+") or coord.startswith("-")) and coord[1:].isdigit():
-        return coord
-    raise ValueError(f"Invalid coordinate '{coord}'. It must be an integer (absolute or relative).")
-    
-
-def validate_coordinates(x: str, y: str) -> Tuple:
-    """Validates if x and y are integers (absolute or relative) and returns them as integers if they are absolute or strings if they are relative."""
-    return validate_coordinate(x), validate_coordinate(y)
-
-
-def check_coordinate_format(coord: str) -> bool:
-    """Checks if a value is a valid coordinate (integer or relative integer)."""
-    return coord.isdigit() or ((coord.startswith("+") or coord.startswith("-")) and coord[1:].isdigit())
+def validate_region(region: str) -> Tuple[int, int, int, int]:
+    """Validates a region of the screen in the format left,top,width,height and returns it as a tuple of integers."""
+    if REGION_RE.fullmatch(region) is None:
+        raise ValueError(f"Invalid region '{region}'. It must be left,top,width,height (integers).")
+    region = tuple(int(value) for value in region.split(","))
+    if region[2] == 0 or region[3] == 0:
+        raise ValueError(f"Invalid region '{region}'. Width and height cannot be 0.")
+    return region
 
 
 def check_mouse_args(args) -> bool:
@@ -312,6 +778,12 @@ def check_mouse_args(args) -> bool:
     if not (0.0 <= args.confidence <= 1.0):
         logger.error("Confidence must be between 0.0 and 1.0.")
         return False
+    if args.region is not None:
+        try:
+            args.region = validate_region(args.region)
+        except ValueError as e:
+            logger.error(e)
+            return False
     return True
 
 
@@ -321,69 +793,140 @@ def check_keyboard_args(args) -> bool:
         logger.error("Typing interval cannot be negative.")
         return False
     if args.typing_interval < MIN_TYPING_INTERVAL:
-        logger.warning(f"Typing interval too low (less than {MIN_TYPING_INTERVAL}s). Setting to type the whole string at once.")
+        logger.warning("Typing interval too low (less than %ss). Setting to type the whole string at once.", MIN_TYPING_INTERVAL)
+        args.typing_interval = 0.0  # Decided once here, typing functions take 0 as typing at once
     if args.press_interval < 0.0:
         logger.error("Press interval cannot be negative.")
         return False
+    if args.uinput and not check_uinput():
+        logger.warning("Cannot type through uinput (python-evdev not installed or /dev/uinput not writable). Typing with xdotool.")
+        args.uinput = False
     return True
 
 
 
 # Parsers
 
+def merge_sleeps(actions: List[Tuple[str, Tuple]]) -> List[Tuple[str, Tuple]]:
+    """Merges consecutive sleep actions into a single one sleeping for their total time."""
+    merged = []
+    for action, args in actions:
+        if action in SLEEP_ACTIONS_SET and merged and merged[-1][0] in SLEEP_ACTIONS_SET:
+            logger.debug("Merging sleep of %s seconds with the previous one", args[0])
+            merged[-1] = (merged[-1][0], (merged[-1][1][0] + args[0],))
+        else:
+            merged.append((action, args))
+    return merged
+
+
+def merge_move_axis(prev: int, prev_relative: bool, value: int, relative: bool) -> Union[Tuple[int, bool], None]:
+    """Merges a coordinate of a mouse move with the one of the previous move, returns it and whether it is relative.
+
+    Returns None when the merged move could end elsewhere, since the mouse is kept on the screen: an offset
+    back from a position that may be past an edge of the screen."""
+    if not relative:
+        return value, False
+    if value == 0:  # Not moving on this axis
+        return prev, prev_relative
+    if prev_relative and (prev == 0 or (prev > 0) == (value > 0)):  # Same direction, the edge stops both the same way
+        return prev + value, True
+    if not prev_relative and value > 0:  # Coordinates are never negative, going further right or down from them
+        return prev + value, False
+    return None
+
+
+def merge_moves(actions: List[Tuple[str, Tuple]]) -> List[Tuple[str, Tuple]]:
+    """Merges consecutive mouse moves to coordinates into a single move to the final position, when it ends in the same place.
+
+    Only meant for instant moves without sleeps between actions, when nothing can happen in the intermediate positions."""
+    merged = []
+    for action, args in actions:
+        if (action == MouseAction.MOVE and len(args) == 4 and merged and merged[-1][0] == MouseAction.MOVE and len(merged[-1][1]) == 4
+                and (x := merge_move_axis(merged[-1][1][0], merged[-1][1][2], args[0], args[2])) is not None
+                and (y := merge_move_axis(merged[-1][1][1], merged[-1][1][3], args[1], args[3])) is not None):
+            logger.debug("Merging move to %s with the previous one", args)
+            merged[-1] = (action, (x[0], y[0], x[1], y[1]))
+        else:
+            merged.append((action, args))
+    return merged
+
+
+def merge_input_moves(actions: List[Tuple[str, Union[str, Tuple]]]) -> List[Tuple[str, Union[str, Tuple]]]:
+    """Merges consecutive mouse moves to coordinates of a parsed input sequence (see merge_moves)."""
+    merged = []
+    for action_type, action in actions:
+        if action_type == ActionType.MOUSE and merged and merged[-1][0] == ActionType.MOUSE and len(moves := merge_moves(merged[-1][1] + action)) == 1:
+            merged[-1] = (ActionType.MOUSE, moves)
+        else:
+            merged.append((action_type, action))
+    return merged
+
+
+def parse_mouse_coordinates(match: re.Match, images_path: Union[str, None]=None) -> Tuple[str, Tuple]:
+    """Parses a mouse action with coordinates, it must be x,y (move) or btn,x,y (M for move).
+
+    The arguments are (x, y, relative_x, relative_y), where x or y are offsets from the current position if relative."""
+    action = MouseAction.MOVE if match.group("btn") is None else validate_mouse_action(match.group("btn"))
+    x, y = match.group("x", "y")
+    return action, (int(x), int(y), not x[0].isdigit(), not y[0].isdigit())  # Signed coordinates are relative
+
+
+def parse_mouse_argument(match: re.Match, images_path: Union[str, None]=None) -> Tuple[str, Tuple]:
+    """Parses a mouse action with an argument, it must be one of:
+    - S,seconds -> sleep
+    - btn,image_path -> click on image"""
+    action, arg = match.group("action", "arg")
+    if (action := validate_mouse_action(action)) == MouseAction.SLEEP:  # Sleep
+        if (seconds := float(arg)) < 0.0:
+            raise ValueError("Sleep time cannot be negative.")
+        return MouseAction.SLEEP, (seconds,)
+    return action, (validate_file_path(arg, images_path),)
+
+
+def parse_mouse_single(match: re.Match, images_path: Union[str, None]=None) -> Tuple[str, Tuple]:
+    """Parses a mouse action with a single part, it must be one of:
+    - btn -> click current position
+    - image_path -> move to image"""
+    single = match.group("single")
+    if single in MOUSE_CLICK_ACTIONS_SET:  # Click current position
+        return validate_mouse_action(single), tuple()
+    return MouseAction.MOVE, (validate_file_path(single, images_path),)  # Move to image
+
+
+MOUSE_ITEM_PARSERS = {  # Last group matched by MOUSE_ITEM_RE -> parser of the mouse action
+    "y": parse_mouse_coordinates,
+    "arg": parse_mouse_argument,
+    "single": parse_mouse_single
+}
+
+
 def parse_mouse_actions(
     actions_str: str,
     images_path: Union[str, None]=None
 ) -> List[Tuple[str, Tuple]]:
     """Converts a string of mouse actions into a list of tuples with action and arguments."""
-    logger.debug(f"Parsing mouse actions: {actions_str}")
+    logger.debug("Parsing mouse actions: %s", actions_str)
     actions = []
     action_tuples = actions_str.split()
     for action_tuple in action_tuples:
-        logger.debug(f"Processing item: {action_tuple}")
+        logger.debug("Processing item: %s", action_tuple)
         try:
-            parts = action_tuple.split(',')
-            # If action has 1 part, it must be one of:
-            # - btn -> click current position
-            # - image_path -> move to image
-            if len(parts) == 1:
-                # action = validate_mouse_action(parts[0])
-                # args = tuple()
-                if parts[0] in MOUSE_CLICK_ACTIONS_LIST:  # Click current position
-                    action = validate_mouse_action(parts[0])
-                    args = tuple()
-                else:  # Move to image
-                    action = MouseAction.MOVE
-                    args = (validate_file_path(parts[0], images_path),)
-            # If action has 2 parts, it must be one of:
-            # - S,seconds -> sleep
-            # - x,y -> left click
-            # - btn,image_path -> click on image
-            elif len(parts) == 2:
-                if parts[0].upper() in MOUSE_SLEEP_ACTIONS_LIST:  # Sleep
-                    action = MouseAction.SLEEP
-                    if (seconds := float(parts[1])) < 0.0:
-                        raise ValueError("Sleep time cannot be negative.")
-                    args = (seconds,)
-                elif check_coordinate_format(parts[0]):  # x,y coordinates
-                    action = MouseAction.MOVE
-                    args = validate_coordinates(parts[0], parts[1])
-                else:
-                    action = validate_mouse_action(parts[0])
-                    args = (validate_file_path(parts[1], images_path),)
-            # If action has 3 parts, it must be btn,x,y or M,x,y
-            elif len(parts) == 3:
-                btn, x, y = parts
-                action = validate_mouse_action(btn)
-                args = validate_coordinates(x, y)
-            else:
-                raise ValueError(f"The action has more than 3 parts separated by commas.")
-            logger.debug(f"Item: {parts} to -> action: {action}, args: {args}")
+            action_str, region = action_tuple, None
+            if (match := ACTION_REGION_RE.fullmatch(action_tuple)) is not None:  # Image action with a region
+                action_str, region = match.group("action"), validate_region(match.group("region"))
+            if (match := MOUSE_ITEM_RE.fullmatch(action_str)) is None:
+                raise ValueError("It must be x,y, btn,x,y, btn,image_path, image_path, btn or S,seconds.")
+            action, args = MOUSE_ITEM_PARSERS[match.lastgroup](match, images_path)
+            if region is not None:
+                if action == MouseAction.SLEEP or len(args) != 1:
+                    raise ValueError("A region can only be used with images.")
+                args = (args[0], region)
+            logger.debug("Item: %s to -> action: %s, args: %s", action_tuple, action, args)
             actions.append((action, args))
         except ValueError as e:
-            logger.error(f"Invalid format for action {action_tuple}: {e}")
+            logger.error("Invalid format for action %s: %s", action_tuple, e)
             exit(1)
-    return actions
+    return merge_sleeps(actions)
 
 
 def parse_keyboard_actions(
@@ -392,47 +935,41 @@ def parse_keyboard_actions(
     from_input=False
 ) -> List[Tuple[str, Union[str, Tuple]]]:
     """Converts a string of keyboard actions into a list of tuples with action and arguments."""
-    logger.debug(f"Parsing keyboard actions: {actions_str}")
+    logger.debug("Parsing keyboard actions: %s", actions_str)
     actions = []
 
     if not from_input:
-        actions_split = shlex.split(actions_str)  # To handle quoted strings with spaces
+        actions_split = split_actions(actions_str)  # To handle quoted strings with spaces
     else:
         actions_split = [actions_str]  # When called from input command, the whole string is one action
     
     for item in actions_split:
         try:
-            logger.debug(f"Processing item: {item}")
+            logger.debug("Processing item: %s", item)
             res = item.split(",", 1)  # Split by comma except the first part
-            action = res[0]
+            action = validate_keyboard_action(res[0])
             args = res[1]
 
-            if action.upper() in KEYBOARD_SLEEP_ACTIONS_LIST:  # Sleep
-                action = KeyboardAction.SLEEP
+            if action == KeyboardAction.SLEEP:  # Sleep
                 if (seconds := float(args)) < 0.0:
                     raise ValueError("Sleep time cannot be negative.")
                 args = (seconds,)
-            elif action.upper() in KEYBOARD_KEY_ACTIONS_LIST:
+            elif action == KeyboardAction.KEY:
                 args = args.split(",")
                 keys = args[0].lower().split('+')
                 presses = 1 if len(args) == 1 else int(args[1])
-                action = KeyboardAction.KEY
                 args = (keys, presses)
-            elif action.upper() in KEYBOARD_TYPE_ACTIONS_LIST:
-                action = KeyboardAction.TYPE
+            elif action == KeyboardAction.TYPE:
                 args = (args,)
-            elif action.upper() in KEYBOARD_TYPEFILE_ACTIONS_LIST:
-                action = KeyboardAction.TYPEFILE
+            else:  # Type file
                 args = (validate_file_path(args, files_path),)
-            else:
-                raise ValueError(f"Invalid action '{action}'. Use {KEYBOARD_ACTIONS_STR}.")
 
-            logger.debug(f"Item: {item} to -> action: {action}, args: {args}")
+            logger.debug("Item: %s to -> action: %s, args: %s", item, action, args)
             actions.append((action, args))
         except ValueError as e:
-            logger.error(f"Invalid format for action {item}: {e}")
+            logger.error("Invalid format for action %s: %s", item, e)
             exit(1)
-    return actions
+    return merge_sleeps(actions)
 
 
 def parse_input_actions(
@@ -441,25 +978,26 @@ def parse_input_actions(
     files_path: Union[str, None]=None
 ) -> List[Tuple[str, Union[str, Tuple]]]:
     """Converts a string of mixed mouse and keyboard actions into a list of tuples with action type and action."""
-    logger.debug(f"Parsing input actions: {actions_str}")
+    logger.debug("Parsing input actions: %s", actions_str)
     combined_actions = []
-    actions_split = shlex.split(actions_str)
+    actions_split = split_actions(actions_str)
 
     # logger.debug(f"Actions split: {actions_split}")
     for item in actions_split:
         try:
-            logger.debug(f"Processing item: {item}")
-            item_split = item.split(",", 1)
-            if len(item_split) == 1 or item_split[0].upper() in MOUSE_ACTIONS_LIST:
+            logger.debug("Processing item: %s", item)
+            item_split = item.split("@", 1)[0].split(",", 1)  # Without the region of an image, if any
+            head = item_split[0].upper()
+            if len(item_split) == 1 or head in MOUSE_ACTIONS_SET:
                 mouse_action = parse_mouse_actions(item, images_path=images_path)
                 combined_actions.append((ActionType.MOUSE, mouse_action))
-            elif item.split(",", 1)[0].upper() in KEYBOARD_ACTIONS_LIST:
+            elif head in KEYBOARD_ACTIONS_SET:
                 keyboard_action = parse_keyboard_actions(item, files_path=files_path, from_input=True)
                 combined_actions.append((ActionType.KEYBOARD, keyboard_action))
             else:
                 raise ValueError("Unknow action. Use mouse or keyboard actions.")
         except ValueError as e:
-            logger.error(f"Invalid format for action {item}: {e}")
+            logger.error("Invalid format for action %s: %s", item, e)
             exit(1)
     return combined_actions
 
@@ -467,78 +1005,130 @@ def parse_input_actions(
 
 # Command functions
 
-@LOCK
-def mouse_cmd(
+def preload_needles(actions: List[Tuple[str, Tuple]], grayscale: bool=DEFAULT_GRAYSCALE):
+    """Decodes every image of a sequence of mouse actions before the first action, so the actions do not wait on disk reads (see load_needle)."""
+    for action, args in actions:
+        if action != MouseAction.SLEEP and (len(args) == 1 or len(args) == 2) and load_needle(args[0], grayscale) is None:
+            logger.error("Image '%s' could not be read.", args[0])
+            exit(1)
+
+
+def run_mouse_actions(
     actions: Tuple[str, Tuple],
     sleep_time: float=DEFAULT_SLEEP_TIME,
     duration: float=DEFAULT_DURATION,
     doubleclick_interval: float=DEFAULT_DOUBLECLICK_INTERVAL,
     confidence: float=DEFAULT_CONFIDENCE,
-    grayscale: bool=DEFAULT_GRAYSCALE
+    grayscale: bool=DEFAULT_GRAYSCALE,
+    region: Union[Tuple[int, int, int, int], None]=None
 ):
-    """Simulate a sequence of mouse movements and clicks, whether on coordinates or on images located on the screen."""
-    logger.debug(f"Starting mouse_cmd with actions: {actions}. Args: sleep_time={sleep_time}, duration={duration}, doubleclick_interval={doubleclick_interval}, confidence={confidence}, grayscale={grayscale}")
+    """Simulate a sequence of mouse movements and clicks, whether on coordinates or on images located on the screen, without taking the lock (see mouse_cmd).
+
+    Images are searched in region (left, top, width, height) unless the action has its own region, or in the whole screen if None."""
+    logger.debug("Starting run_mouse_actions with actions: %s. Args: sleep_time=%s, duration=%s, doubleclick_interval=%s, confidence=%s, grayscale=%s, region=%s", actions, sleep_time, duration, doubleclick_interval, confidence, grayscale, region)
+    pyautogui = import_pyautogui()
+    tweens = tuple(getattr(pyautogui, name) for name in TWEENING_FUNCTIONS)
+
+    screen = None  # Screenshot shared by image locates until an action may change the display
+    last_match = {}  # Image path -> box where it was last found (in screen coordinates)
+    screen_matches = {}  # (Image path, region) -> box where it was found on the current screenshot
+    xtest_display = None  # Set when XTEST events were sent and the X server has not confirmed them yet
+    last_pos = None  # Where the last action left the mouse, unknown at the start and after sleeping (the mouse may be moved meanwhile)
+    screen_size = tuple(pyautogui.size())  # To know where the mouse ends when a target is off the screen
+
+    preload_needles(actions, grayscale)
 
     for i, (action, args) in enumerate(actions):
-        logger.debug(f"Processing action: {action} with args: {args}")
+        logger.debug("Processing action: %s with args: %s", action, args)
         if action == MouseAction.SLEEP:  # Sleep
             seconds = args[0]
             if seconds > 0.0:
-                logger.debug(f"Sleeping for {seconds} seconds (overriding global sleep time of {sleep_time} seconds).")
+                logger.debug("Sleeping for %s seconds (overriding global sleep time of %s seconds).", seconds, sleep_time)
                 time.sleep(seconds)
+                screen = None
+                last_pos = None
         else:
+            if xtest_display is not None and (last_pos is None or len(args) == 1 or len(args) == 2):
+                xtest_display.sync()  # The position or screenshot read below must see the sent events
+                xtest_display = None
             if len(args) == 0:  # Click on current mouse position
-                x, y = pyautogui.position()
-            elif len(args) == 1:  # Click on image
+                x, y = last_pos if last_pos is not None else pyautogui.position()
+            elif len(args) == 1 or len(args) == 2:  # Click on image (with its own region)
                 img_path = args[0]
-                logger.debug(f"Locating image on screen: {img_path}")
-                location = pyautogui.locateCenterOnScreen(img_path, confidence=confidence, grayscale=grayscale)
-                if location is None:
-                    logger.error(f"Image '{img_path}' not found on screen.")
-                    exit(1)
-                x, y = location
-                logger.debug(f"Image found at ({x}, {y})")
-            elif len(args) == 2:  # Click on coordinates
-                x, y = args
-                cur_pos = pyautogui.position()
-                x = x if isinstance(x, int) else cur_pos.x + int(x)
-                y = y if isinstance(y, int) else cur_pos.y + int(y)
+                img_region = args[1] if len(args) == 2 else region
+                if screen is None:
+                    logger.debug("Taking screenshot")
+                    screen = grab_screen(grayscale)
+                    screen_matches.clear()
+                if (box := screen_matches.get((img_path, img_region))) is None:  # Not searched yet on this screenshot
+                    logger.debug("Locating image on screen: %s (region: %s)", img_path, img_region)
+                    box = locate_on_screenshot(img_path, screen, last_match.get(img_path), region=img_region, confidence=confidence, grayscale=grayscale)
+                    if box is None:
+                        logger.error("Image '%s' not found on screen.", img_path)
+                        exit(1)
+                    last_match[img_path] = screen_matches[(img_path, img_region)] = box
+                x, y = pyautogui.center(box)
+                logger.debug("Image found at (%s, %s)", x, y)
+            else:  # Click on coordinates
+                x, y, relative_x, relative_y = args
+                if relative_x or relative_y:  # The current position is only needed here
+                    cur_x, cur_y = last_pos if last_pos is not None else pyautogui.position()
+                    x = cur_x + x if relative_x else x
+                    y = cur_y + y if relative_y else y
 
             if duration > 0.0 or action == MouseAction.MOVE:  # Move mouse
-                logger.debug(f"Moving mouse to ({x}, {y}) with duration {duration} seconds")
-                pyautogui.moveTo(x, y, tween=random.choice(TWEENING_FUNCTIONS), duration=duration)
+                logger.debug("Moving mouse to (%s, %s) with duration %s seconds", x, y, duration)
+                if duration == 0.0 and (display := get_xtest_display()) is not None:
+                    move_with_xtest(display, x, y)
+                    xtest_display = display
+                else:
+                    tween = tweens[random.getrandbits(1)] if duration > 0.0 else pyautogui.linear  # Tween is ignored when not moving over time
+                    pyautogui.moveTo(x, y, tween=tween, duration=duration)
+                if duration > 0.0:
+                    screen = None
             
             if action != MouseAction.MOVE:  # Not just moving
-                btn_mapped = BTN_MAPPING[action]  # Map button to pyautogui constant
-                single_click = action != MouseAction.DOUBLELEFT
-                clicks = 1 if single_click else 2
-                interval = 0.0 if single_click else doubleclick_interval
-                msg = "Clicked" if single_click else "Double clicked"
-
-                pyautogui.click(x, y, button=btn_mapped, clicks=clicks, interval=interval)
-                logger.debug(f"{msg} {btn_mapped} button on ({x}, {y})")
+                btn_mapped, x_button, clicks = BTN_MAPPING[action]
+                interval = doubleclick_interval if clicks > 1 else 0.0
+                if duration == 0.0 and (display := get_xtest_display()) is not None:
+                    click_with_xtest(display, x, y, x_button, clicks=clicks, interval=interval)
+                    xtest_display = display
+                else:
+                    pyautogui.click(x, y, button=btn_mapped, clicks=clicks, interval=interval)
+                logger.debug("%s %s button on (%s, %s)", "Clicked" if clicks == 1 else "Double clicked", btn_mapped, x, y)
+                screen = None
+            last_pos = clamp_to_screen(x, y, screen_size)  # Not the target, relative moves start from the actual position
 
             if sleep_time > 0.0 and i < len(actions) - 1:  # No sleep after the last action
-                logger.debug(f"Waiting {sleep_time} seconds after the mouse action.")
+                logger.debug("Waiting %s seconds after the mouse action.", sleep_time)
                 time.sleep(sleep_time)
+                screen = None
+                last_pos = None
 
+    if xtest_display is not None:
+        xtest_display.sync()  # Do not return (and release the lock) before the X server has processed the events
 
-@LOCK
-def keyboard_cmd(
+
+mouse_cmd = LOCK(run_mouse_actions)  # Holding the lock, for the mouse command
+
+
+def run_keyboard_actions(
     actions: Tuple[str, Union[str, Tuple]],
     sleep_time: float=DEFAULT_SLEEP_TIME,
     typing_interval: float=DEFAULT_TYPING_INTERVAL,
-    press_interval: float=DEFAULT_PRESS_INTERVAL
+    press_interval: float=DEFAULT_PRESS_INTERVAL,
+    uinput: bool=False
 ):
-    """Simulate a sequence of keyboard key presses and typing."""
-    logger.debug(f"Starting keyboard_cmd with actions: {actions}. Args: sleep_time={sleep_time}, typing_interval={typing_interval}, press_interval={press_interval}")
+    """Simulate a sequence of keyboard key presses and typing, without taking the lock (see keyboard_cmd)."""
+    logger.debug("Starting run_keyboard_actions with actions: %s. Args: sleep_time=%s, typing_interval=%s, press_interval=%s, uinput=%s", actions, sleep_time, typing_interval, press_interval, uinput)
+    pyautogui = import_pyautogui()
 
     for i, (action, args) in enumerate(actions):
-        logger.debug(f"Processing action: {action} with args: {args}")
+        logger.debug("Processing action: %s with args: %s", action, args)
         if action == KeyboardAction.SLEEP:  # Sleep
             seconds = args[0]
             if seconds > 0.0:
-                logger.debug(f"Sleeping for {seconds} seconds (overriding global sleep time of {sleep_time} seconds).")
+                logger.debug("Sleeping for %s seconds (overriding global sleep time of %s seconds).", seconds, sleep_time)
                 time.sleep(seconds)
         else:
             if action == KeyboardAction.KEY:  # Key press or combination
@@ -546,38 +1136,52 @@ def keyboard_cmd(
                 presses = args[1]
                 if len(keys) == 1:
                     key = keys[0]
-                    logger.debug(f"Pressing key {key} {presses} times with interval {press_interval} seconds between presses")
-                    pyautogui.press(key, presses=presses, interval=press_interval)
+                    logger.debug("Pressing key %s %s times with interval %s seconds between presses", key, presses, press_interval)
+                    if (display := get_xtest_display()) is not None and (keycode := get_xtest_keycode(display, key)) is not None:
+                        press_with_xtest(display, keycode, presses=presses, interval=press_interval)
+                    else:
+                        pyautogui.press(key, presses=presses, interval=press_interval)
                 else:
-                    logger.debug(f"Pressing key combination {keys} {presses} times with interval {press_interval} seconds between presses")
-                    for _ in range(presses):
-                        pyautogui.hotkey(*keys)
-                        if press_interval > 0.0:
-                            time.sleep(press_interval)
+                    logger.debug("Pressing key combination %s %s times with interval %s seconds between presses", keys, presses, press_interval)
+                    if (combination := get_xdotool_combination(keys)) is not None:
+                        press_hotkey_with_xdotool(combination, presses=presses, interval=press_interval)
+                    else:  # A key name unknown to xdotool
+                        for j in range(presses):
+                            if j > 0 and press_interval > 0.0:
+                                time.sleep(press_interval)
+                            pyautogui.hotkey(*keys)
             elif action == KeyboardAction.TYPE:  # Type string
                 string_to_type = args[0]
-                logger.debug(f"Typing string: {string_to_type} with interval {typing_interval} seconds between characters")
-                type_with_xdotool(string_to_type, interval=typing_interval)
+                logger.debug("Typing string: %s with interval %s seconds between characters", string_to_type, typing_interval)
+                type_string(string_to_type, interval=typing_interval, uinput=uinput)
                 # pyautogui.write(string_to_type, interval=typing_interval)
             elif action == KeyboardAction.TYPEFILE:  # Type content of file
                 file_path = args[0]
-                logger.debug(f"Typing content of file: {file_path} with interval {typing_interval} seconds between characters")
+                logger.debug("Typing content of file: %s with interval %s seconds between characters", file_path, typing_interval)
                 try:
                     with open(file_path, 'r') as file:
-                        content = file.read()
-                    type_with_xdotool(content, interval=typing_interval)
+                        if uinput:  # The whole content is needed to check if it can be typed through uinput
+                            type_string(file.read(), interval=typing_interval, uinput=uinput)
+                        elif not (typing_interval < MIN_TYPING_INTERVAL and (wtype := get_wtype()) is not None and type_file_with_wtype(wtype, file)):
+                            type_file_with_xdotool(file, interval=typing_interval)  # Stream the file to xdotool, also if wtype failed
+                except BrokenPipeError:  # Before OSError, it is a subclass
+                    logger.error("xdotool exited before typing the whole content of file '%s'.", file_path)
+                    exit(1)
                 except OSError as e:
-                    logger.error(f"Error reading file '{file_path}': {e}")
+                    logger.error("Error reading file '%s': %s", file_path, e)
                     exit(1)
             else:
-                logger.error(f"Unknown action '{action}' in keyboard_cmd.")
+                logger.error("Unknown action '%s' in run_keyboard_actions.", action)
                 exit(1)
             
             if sleep_time > 0.0 and i < len(actions) - 1:  # No sleep after the last action
-                logger.debug(f"Waiting {sleep_time} seconds after the keyboard action.")
+                logger.debug("Waiting %s seconds after the keyboard action.", sleep_time)
                 time.sleep(sleep_time)
 
 
+keyboard_cmd = LOCK(run_keyboard_actions)  # Holding the lock, for the keyboard command
+
+
 @LOCK
 def input_cmd(
     actions: List[Tuple[str, Union[str, Tuple]]],
@@ -587,41 +1191,34 @@ def input_cmd(
     confidence: float=DEFAULT_CONFIDENCE,
     grayscale: bool=DEFAULT_GRAYSCALE,
     typing_interval: float=DEFAULT_TYPING_INTERVAL,
-    press_interval: float=DEFAULT_PRESS_INTERVAL
+    press_interval: float=DEFAULT_PRESS_INTERVAL,
+    uinput: bool=False,
+    region: Union[Tuple[int, int, int, int], None]=None
 ):
     """Simulate a sequence of mouse and keyboard actions."""
-    logger.debug(f"Starting input_cmd with actions: {actions}. Args: sleep_time={sleep_time}, duration={duration}, doubleclick_interval={doubleclick_interval}, confidence={confidence}, grayscale={grayscale}, typing_interval={typing_interval}, press_interval={press_interval}")
+    logger.debug("Starting input_cmd with actions: %s. Args: sleep_time=%s, duration=%s, doubleclick_interval=%s, confidence=%s, grayscale=%s, typing_interval=%s, press_interval=%s, uinput=%s, region=%s", actions, sleep_time, duration, doubleclick_interval, confidence, grayscale, typing_interval, press_interval, uinput, region)
+    preload_needles([mouse_action for action_type, action in actions if action_type == ActionType.MOUSE for mouse_action in action], grayscale)  # Not only those of the next mouse action
 
     for i, (action_type, action) in enumerate(actions):
         if action_type == ActionType.MOUSE:
-            mouse_cmd(action, sleep_time, duration, doubleclick_interval)
+            run_mouse_actions(action, sleep_time, duration, doubleclick_interval, confidence, grayscale, region)  # The lock is already held
         elif action_type == ActionType.KEYBOARD:
-            keyboard_cmd(action, sleep_time, typing_interval, press_interval)
+            run_keyboard_actions(action, sleep_time, typing_interval, press_interval, uinput)
         else:
-            logger.error(f"Unknown action type '{action_type}' in input_cmd.")
+            logger.error("Unknown action type '%s' in input_cmd.", action_type)
             exit(1)
 
-        is_sleep_action = action[0][0] in (MOUSE_SLEEP_ACTIONS_LIST if action_type == ActionType.MOUSE else KEYBOARD_SLEEP_ACTIONS_LIST)
+        is_sleep_action = action[0][0] in SLEEP_ACTIONS_SET  # Parsed actions have their full names
         if not is_sleep_action and sleep_time > 0.0 and i < len(actions) - 1:  # No sleep after the last action
-            logger.debug(f"Waiting {sleep_time} seconds after the last action of type {action_type}.")
+            logger.debug("Waiting %s seconds after the last action of type %s.", sleep_time, action_type)
             time.sleep(sleep_time)
 
 
 
 # Main
 
-def main():
-    parser = argparse.ArgumentParser(
-        prog="input-simulation",
-        description="Simulate input such as clicking, moving the mouse or typing", 
-        # epilog=example, 
-        # formatter_class=argparse.RawDescriptionHelpFormatter
-    )
-
-    # Subcommands
-    subparsers = parser.add_subparsers(dest='command', required=True, help='Command to execute')
-
-    # Mouse command
+def add_mouse_parser(subparsers):
+    """Adds the subparser of the mouse command."""
     mouse_parser = subparsers.add_parser(
         "mouse", 
         help="Simulate a sequence of mouse movements and clicks, whether on coordinates or on images located on the screen.",
@@ -634,9 +1231,9 @@ def main():
                               "If clicking, it must be in the format: btn,x,y or btn,image_path if single click, "
                               "or a list in the format 'btn,x,y btn,image_path btn,x,y' if multiple clicks (always in single or double quotes). "
                               "btn can be L (left), R (right), W (middle, wheel button) or LL (left double click). "
-                              "image_path is the path to an image file to locate on the screen. "
+                              "image_path is the path to an image file to locate on the screen, it can be followed by @left,top,width,height to search only in that area. "
                               "If sleeping, it must be in the format: S,seconds, where seconds is a float number of seconds to sleep. "
-                              "Global sleep time between actions can be set with --sleep. "
+                              "Global sleep time between actions can be set with --sleep (there is no other pause between actions). "
                               "Coordinates in x,y and image_path can be used in the same sequence, as well as sleeping. ")
     mouse_parser.add_argument("--sleep", type=float, help="Time in seconds (float) to sleep after each action. If a sleep action is used in the sequence of actions, it overrides this argument. Defaults to 0.0s", default=DEFAULT_SLEEP_TIME, required=False)
     mouse_parser.add_argument("--doubleclick-interval", type=float, help="Time in seconds (float) between clicks for a double click. Defaults to 0.1s.", default=DEFAULT_DOUBLECLICK_INTERVAL, required=False)
@@ -644,10 +1241,14 @@ def main():
     mouse_parser.add_argument("--confidence", type=float, help="Confidence level (0.0 to 1.0) for image recognition. Defaults to 0.8.", default=DEFAULT_CONFIDENCE, required=False)
     mouse_parser.add_argument("--grayscale", action="store_true", help="Use grayscale for image recognition. This is the default option.", default=DEFAULT_GRAYSCALE, required=False)
     mouse_parser.add_argument("--no-grayscale", action="store_false", dest="grayscale", help="Do not use grayscale for image recognition.", required=False)
+    mouse_parser.add_argument("--region", type=str, help="Area of the screen (left,top,width,height) where images are searched, smaller areas are searched faster. "
+                              "An image action can set its own region with image_path@left,top,width,height. Defaults to the whole screen.", default=None, required=False)
     mouse_parser.add_argument("--images-path", type=str, help="Path to a directory where images used for image recognition are stored. If set, image paths in actions can be relative to this path.", default=None, required=False)
     mouse_parser.add_argument("--debug", action="store_true", help="Enable debug mode.", required=False)
 
-    # Keyboard command
+
+def add_keyboard_parser(subparsers):
+    """Adds the subparser of the keyboard command."""
     keyboard_parser = subparsers.add_parser(
         "keyboard", 
         help="Simulate a sequence of pressing keys or hotkeys and typing text.",
@@ -660,18 +1261,22 @@ def main():
                                   "key can be a single key or a combination of keys separated by + (e.g., ctrl+shift+c). "
                                   "If typing a string, it must be in the format: T,'string' (always in quotes) or T,/path/to/file.txt if typing the content of a file. "
                                   "If sleeping, it must be in the format: S,seconds, where seconds is a float number of seconds to sleep. "
-                                  "Global sleep time between actions can be set with --sleep. "
+                                  "Global sleep time between actions can be set with --sleep (there is no other pause between actions). "
                                   "Pressing, typing and sleeping can be used in the same sequence.")
     keyboard_parser.add_argument("--sleep", type=float, help="Time in seconds (float) to sleep after each action. If sleep action is used in the sequence of actions, it overrides this argument. Defaults to 0.0s", default=DEFAULT_SLEEP_TIME, required=False)
     keyboard_parser.add_argument("--typing-interval", type=float, help="Time in seconds (float) between each character when typing a string. Defaults to 0.05s. "
-                                 "Minimum is 0.025s, lower values will type the whole string at once. "
+                                 "Minimum is 0.025s, lower values will type the whole string at once (with wtype in Wayland sessions, if installed and supported). "
                                  "Values lower than 0.05s may cause issues on some systems (such as missing characters).", 
                                  default=DEFAULT_TYPING_INTERVAL, required=False)
     keyboard_parser.add_argument("--press-interval", type=float, help="Time in seconds (float) between each key press when pressing keys multiple times. Defaults to 0.0s", default=DEFAULT_PRESS_INTERVAL, required=False)
     keyboard_parser.add_argument("--files-path", type=str, help="Path to a directory where text files used for typing are stored. If set, file paths in actions can be relative to this path.", default=None, required=False)
+    keyboard_parser.add_argument("--uinput", action="store_true", help="Type through a virtual uinput keyboard (requires python-evdev and write access to /dev/uinput) instead of xdotool. "
+                                 "Assumes a US keyboard layout, strings with other characters are still typed with xdotool.", required=False)
     keyboard_parser.add_argument("--debug", action="store_true", help="Enable debug mode.", required=False)
 
-    # Input command (combined mouse and keyboard)
+
+def add_input_parser(subparsers):
+    """Adds the subparser of the input command (combined mouse and keyboard)."""
     input_parser = subparsers.add_parser(
         "input", 
         help="Simulate a sequence of mouse and keyboard actions.",
@@ -686,17 +1291,57 @@ def main():
     input_parser.add_argument("--confidence", type=float, help="Confidence level (0.0 to 1.0) for image recognition. Defaults to 0.8.", default=DEFAULT_CONFIDENCE, required=False)
     input_parser.add_argument("--grayscale", action="store_true", help="Use grayscale for image recognition. This is the default option.", default=DEFAULT_GRAYSCALE, required=False)
     input_parser.add_argument("--no-grayscale", action="store_false", dest="grayscale", help="Do not use grayscale for image recognition.", required=False)
+    input_parser.add_argument("--region", type=str, help="Area of the screen (left,top,width,height) where images are searched, smaller areas are searched faster. "
+                              "An image action can set its own region with image_path@left,top,width,height. Defaults to the whole screen.", default=None, required=False)
     input_parser.add_argument("--images-path", type=str, help="Path to a directory where images used for image recognition are stored. If set, image paths in actions can be relative to this path.", default=None, required=False)
     input_parser.add_argument("--typing-interval", type=float, help="Time in seconds (float) between each character when typing a string. Defaults to 0.05s. "
-                                 "Minimum is 0.025s, lower values will type the whole string at once. "
+                                 "Minimum is 0.025s, lower values will type the whole string at once (with wtype in Wayland sessions, if installed and supported). "
                                  "Values lower than 0.05s may cause issues on some systems (such as missing characters).", 
                                  default=DEFAULT_TYPING_INTERVAL, required=False)
     input_parser.add_argument("--press-interval", type=float, help="Time in seconds (float) between each key press when pressing keys multiple times. Defaults to 0.0s", default=DEFAULT_PRESS_INTERVAL, required=False)
     input_parser.add_argument("--files-path", type=str, help="Path to a directory where text files used for typing are stored. If set, file paths in actions can be relative to this path.", default=None, required=False)
+    input_parser.add_argument("--uinput", action="store_true", help="Type through a virtual uinput keyboard (requires python-evdev and write access to /dev/uinput) instead of xdotool. "
+                              "Assumes a US keyboard layout, strings with other characters are still typed with xdotool.", required=False)
     input_parser.add_argument("--debug", action="store_true", help="Enable debug mode.", required=False)
 
 
-    args, unknown = parser.parse_known_args()
+COMMAND_PARSERS = {  # Command -> function adding its subparser
+    "mouse": add_mouse_parser,
+    "keyboard": add_keyboard_parser,
+    "input": add_input_parser,
+}
+
+
+@functools.lru_cache(maxsize=len(COMMAND_PARSERS) + 1)
+def build_parser(command: Union[str, None]=None) -> argparse.ArgumentParser:
+    """Builds (once per command) the parser of the command line arguments.
+
+    Only the subparser of the given command is added, since it is the only one used. For any other value
+    (no command, -h, a typo...) all subparsers are added, so the help and the errors list every command."""
+    parser = argparse.ArgumentParser(
+        prog="input-simulation",
+        description="Simulate input such as clicking, moving the mouse or typing", 
+        # epilog=example, 
+        # formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+
+    # Subcommands
+    subparsers = parser.add_subparsers(dest='command', required=True, help='Command to execute')
+    if command in COMMAND_PARSERS:
+        COMMAND_PARSERS[command](subparsers)
+    else:
+        for add_parser in COMMAND_PARSERS.values():
+            add_parser(subparsers)
+    return parser
+
+
+def parse_command(arguments: Union[List[str], None]=None) -> Tuple[argparse.Namespace, List[Tuple]]:
+    """Parses and checks the command line arguments (sys.argv if None) and the actions of the command, returns both.
+
+    The result can be passed to main() to run the same command several times without parsing it again."""
+    arguments = sys.argv[1:] if arguments is None else arguments  # Read when called, sys.argv may have been replaced since the import
+    command = arguments[0] if arguments else None
+    args, unknown = build_parser(command).parse_known_args(arguments)
 
     if args.debug:
         console_handler.setFormatter(formatter)
@@ -706,7 +1351,7 @@ def main():
     
     logger.info("Starting input-simulation")
     if unknown:
-        logger.warning(f"Unknown arguments ignored: {unknown}")
+        logger.warning("Unknown arguments ignored: %s", unknown)
 
 
     if args.sleep < 0.0:
@@ -716,26 +1361,42 @@ def main():
     if args.command == "mouse":
         if not check_mouse_args(args):
             exit(1)
-        mouse_actions = parse_mouse_actions(args.actions, images_path=args.images_path)
-        logger.debug(f"Trying to acquire lock on {LOCK.lock_file}")
-        mouse_cmd(mouse_actions, args.sleep, args.duration, args.doubleclick_interval)
+        actions = parse_mouse_actions(args.actions, images_path=args.images_path)
+        if args.sleep == 0.0 and args.duration == 0.0:  # Intermediate positions are not visible
+            actions = merge_moves(actions)
     elif args.command == "keyboard":
         if not check_keyboard_args(args):
             exit(1)
-        keyboard_actions = parse_keyboard_actions(args.actions, files_path=args.files_path)
-        logger.debug(f"Trying to acquire lock on {LOCK.lock_file}")
-        keyboard_cmd(keyboard_actions, args.sleep, args.typing_interval, args.press_interval)
+        actions = parse_keyboard_actions(args.actions, files_path=args.files_path)
     elif args.command == "input":
         if not check_mouse_args(args) or not check_keyboard_args(args):
             exit(1)
-        combined_actions = parse_input_actions(args.actions, images_path=args.images_path, files_path=args.files_path)
-        logger.debug(f"Trying to acquire lock on {LOCK.lock_file}")
-        input_cmd(combined_actions, args.sleep, args.duration, args.doubleclick_interval, args.confidence, args.grayscale, args.typing_interval, args.press_interval)
+        actions = parse_input_actions(args.actions, images_path=args.images_path, files_path=args.files_path)
+        if args.sleep == 0.0 and args.duration == 0.0:
+            actions = merge_input_moves(actions)
     else:
         logger.error("Invalid command")
         exit(1)
+    return args, actions
+
+
+def main(arguments: Union[List[str], None]=None, parsed: Union[Tuple[argparse.Namespace, List[Tuple]], None]=None):
+    """Runs a command from the command line arguments (sys.argv if None), or from the result of parse_command if given."""
+    if parsed is None:
+        parsed = parse_command(arguments)
+    else:
+        logger.info("Starting input-simulation")
+    args, actions = parsed
+
+    logger.debug("Trying to acquire lock on %s", LOCK.lock_file)
+    if args.command == "mouse":
+        mouse_cmd(actions, args.sleep, args.duration, args.doubleclick_interval, args.confidence, args.grayscale, args.region)
+    elif args.command == "keyboard":
+        keyboard_cmd(actions, args.sleep, args.typing_interval, args.press_interval, args.uinput)
+    else:
+        input_cmd(actions, args.sleep, args.duration, args.doubleclick_interval, args.confidence, args.grayscale, args.typing_interval, args.press_interval, args.uinput, args.region)
     
-    logger.debug(f"Lock released on {LOCK.lock_file}")
+    logger.debug("Lock released on %s", LOCK.lock_file)
     logger.info("Finishing input-simulation")
 
 